@@ -11,6 +11,22 @@ class Settings(BaseSettings):
     log_level: str = "INFO"
     api_port: int = 8000
     
+    # Caching
+    metadata_cache_size: int = 4096
+    metadata_cache_ttl: int = 3600
+    songlink_cache_dir: str = ".songlink-cache"
+    songlink_cache_ttl: int = 86400
+    resolve_page_url_strict: bool = False
+    
+    # Outbound API limits
+    max_concurrency: int = 20
+    spotify_requests_per_minute: int = 600
+    songlink_requests_per_minute: int = 60
+    spotify_batch_window_ms: int = 10
+    
+    # Health checks
+    health_cache_ttl: int = 30
+    
     class Config:
         env_file = ".env"
 
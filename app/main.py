@@ -1,5 +1,10 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from contextlib import asynccontextmanager
+import asyncio
+import requests
+import spotipy
 import time
 import logging
 from .models import *
@@ -10,27 +15,79 @@ from .config import settings
 logging.basicConfig(level=settings.log_level)
 logger = logging.getLogger(__name__)
 
+# Confidence score by number of matched non-Spotify platforms: min(0.95, 0.5 + 0.08 * n)
+_CONFIDENCE_TABLE = (0.5, 0.58, 0.66, 0.74, 0.82, 0.90, 0.95)
+
+# Seconds clients should wait before retrying after an upstream outage
+_RETRY_AFTER_SECONDS = 5
+
+# Error detail prefix for each endpoint, keyed by route name
+_ERROR_PREFIXES = {
+    "search_music": "Search failed",
+    "match_across_platforms": "Matching failed",
+    "get_landing_page_data": "Landing page data failed",
+    "get_preview_card_data": "Preview card failed"
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize services
+    app.state.spotify_service = SpotifyService()
+    app.state.songlink_service = SongLinkService()
+    # Fetch the Spotify token and open the SongLink connection before the first request
+    await asyncio.gather(
+        app.state.spotify_service.warm_up(),
+        app.state.songlink_service.warm_up()
+    )
+    yield
+    # Release pooled connections on shutdown
+    await app.state.songlink_service.aclose()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Music Booster Service",
     description="Search music and get cross-platform streaming links",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Configure properly in production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Services live on app.state for the lifetime of the app
+def get_spotify_service(request: Request) -> SpotifyService:
+    return request.app.state.spotify_service
+
+def get_songlink_service(request: Request) -> SongLinkService:
+    return request.app.state.songlink_service
+
+def _is_retryable(exc: Exception) -> bool:
+    """Upstream timeouts, connection errors, rate limits and 5xx are worth retrying"""
+    # spotipy lets timeouts and connection errors from requests through unwrapped
+    if isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    return isinstance(exc, spotipy.SpotifyException) and (exc.http_status == 429 or exc.http_status >= 500)
 
-# Initialize services
-spotify_service = SpotifyService()
-songlink_service = SongLinkService()
+# Middleware for unhandled errors
+@app.middleware("http")
+async def handle_errors(request, call_next):
+    try:
+        return await call_next(request)
+    except Exception as e:
+        logger.error(f"{request.method} {request.url.path} failed: {e}", exc_info=True)
+        # The router records the matched route in the shared scope
+        route = request.scope.get("route")
+        route_name = getattr(route, "name", None)
+        if route_name == "health_check":
+            return ORJSONResponse(status_code=503, content={"detail": "Service unhealthy"})
+        if _is_retryable(e):
+            return ORJSONResponse(
+                status_code=503,
+                content={"detail": f"Upstream service unavailable: {str(e)}"},
+                headers={"Retry-After": str(_RETRY_AFTER_SECONDS)}
+            )
+        prefix = _ERROR_PREFIXES.get(route_name, "Request failed")
+        return ORJSONResponse(status_code=500, content={"detail": f"{prefix}: {str(e)}"})
 
 # Middleware for request timing
 @app.middleware("http")
@@ -39,150 +96,154 @@ async def add_process_time_header(request, call_next):
     response = await call_next(request)
     process_time = time.time() - start_time
     response.headers["X-Process-Time"] = str(process_time)
-    logger.info(f"{request.method} {request.url.path} - {process_time:.3f}s")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"{request.method} {request.url.path} - {process_time:.3f}s")
     return response
 
+# CORS middleware, added last so it is outermost and also covers error responses
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Configure properly in production
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # Health check endpoint
 @app.get("/health")
-async def health_check():
+async def health_check(spotify_service: SpotifyService = Depends(get_spotify_service)):
     """Health check endpoint for monitoring"""
-    try:
-        # Test Spotify connection
-        spotify_status = spotify_service.test_connection()
-        return {
-            "status": "healthy",
-            "timestamp": time.time(),
-            "services": {
-                "spotify": "up" if spotify_status else "down",
-                "songlink": "up"  # No auth required, assume up
-            }
+    # Test Spotify connection
+    spotify_status = await spotify_service.test_connection()
+    return {
+        "status": "healthy",
+        "timestamp": time.time(),
+        "services": {
+            "spotify": "up" if spotify_status else "down",
+            "songlink": "up"  # No auth required, assume up
         }
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        raise HTTPException(status_code=503, detail="Service unhealthy")
+    }
 
 # Search endpoint
 @app.post("/search", response_model=SearchResponse)
-async def search_music(request: SearchRequest):
+async def search_music(request: SearchRequest, spotify_service: SpotifyService = Depends(get_spotify_service)):
     """Search for music - returns mixed results (tracks + albums)"""
-    try:
-        logger.info(f"Searching for: {request.query}")
-        
-        results = await spotify_service.search_mixed(request.query, request.limit)
-        
-        return SearchResponse(
-            query=request.query,
-            total_results=len(results),
-            results=results
-        )
-        
-    except Exception as e:
-        logger.error(f"Search failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+    logger.info(f"Searching for: {request.query}")
+    
+    results = await spotify_service.search_mixed(request.query, request.limit)
+    
+    return SearchResponse(
+        query=request.query,
+        total_results=len(results),
+        results=results
+    )
 
 # Cross-platform matching
 @app.post("/match/{spotify_id}", response_model=MatchResult)
-async def match_across_platforms(spotify_id: str, content_type: str = "track"):
+async def match_across_platforms(
+    spotify_id: str,
+    content_type: str = "track",
+    spotify_service: SpotifyService = Depends(get_spotify_service),
+    songlink_service: SongLinkService = Depends(get_songlink_service)
+):
     """Get cross-platform links for a Spotify track or album"""
-    try:
-        logger.info(f"Matching {content_type}: {spotify_id}")
-        
-        # Get metadata from Spotify
-        if content_type == "track":
-            metadata = await spotify_service.get_track_metadata(spotify_id)
-        else:
-            metadata = await spotify_service.get_album_metadata(spotify_id)
-        
-        # Get cross-platform links
-        platform_links = await songlink_service.get_platform_links(metadata.spotify_url)
-        
-        # Calculate confidence score
-        platform_count = sum([
-            1 for link in [
-                platform_links.apple_music, platform_links.youtube_music,
-                platform_links.deezer, platform_links.amazon_music,
-                platform_links.tidal, platform_links.soundcloud
-            ] if link
-        ])
-        confidence_score = min(0.95, 0.5 + (platform_count * 0.08))
-        
-        return MatchResult(
-            metadata=metadata.dict(),
-            dsp_links=platform_links,
-            confidence_score=confidence_score,
-            content_type=content_type
-        )
-        
-    except Exception as e:
-        logger.error(f"Matching failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Matching failed: {str(e)}")
+    logger.info(f"Matching {content_type}: {spotify_id}")
+    
+    # Get metadata from Spotify
+    if content_type == "track":
+        metadata = await spotify_service.get_track_metadata(spotify_id)
+    else:
+        metadata = await spotify_service.get_album_metadata(spotify_id)
+    
+    # Get cross-platform links
+    platform_links = await songlink_service.get_platform_links(metadata.spotify_url)
+    
+    # Calculate confidence score
+    platform_count = (
+        bool(platform_links.apple_music) + bool(platform_links.youtube_music)
+        + bool(platform_links.deezer) + bool(platform_links.amazon_music)
+        + bool(platform_links.tidal) + bool(platform_links.soundcloud)
+    )
+    confidence_score = _CONFIDENCE_TABLE[platform_count]
+    
+    return MatchResult(
+        metadata=metadata.model_dump(),
+        dsp_links=platform_links,
+        confidence_score=confidence_score,
+        content_type=content_type
+    )
+
+async def _fetch_all(spotify_service: SpotifyService, songlink_service: SongLinkService, spotify_id: str):
+    """Fetch track metadata and its raw SongLink response"""
+    metadata = await spotify_service.get_track_metadata(spotify_id)
+    # One SongLink fetch serves both the deep links and the page URL
+    links_data = await songlink_service.fetch_links(metadata.spotify_url)
+    return metadata, links_data
+
+def _assemble_landing(metadata: TrackMetadata, platform_data: DetailedPlatformLinks, songlink_page: str) -> LandingPageData:
+    """Build landing page data from already-fetched pieces"""
+    return LandingPageData(
+        title=metadata.title,
+        artist=metadata.artist,
+        album=metadata.album,
+        thumbnail_small=metadata.cover_image,  # Could implement multiple sizes
+        thumbnail_medium=metadata.cover_image,
+        thumbnail_large=metadata.cover_image,
+        platforms=platform_data,
+        songlink_page_url=songlink_page,
+        duration_ms=metadata.duration_ms,
+        isrc=metadata.isrc,
+        release_date=metadata.release_date,
+        popularity=metadata.popularity,
+        preview_url=metadata.preview_url,
+        spotify_id=metadata.spotify_id
+    )
 
 # Rich landing page data
 @app.get("/landing/{spotify_id}", response_model=LandingPageData)
-async def get_landing_page_data(spotify_id: str):
+async def get_landing_page_data(
+    spotify_id: str,
+    spotify_service: SpotifyService = Depends(get_spotify_service),
+    songlink_service: SongLinkService = Depends(get_songlink_service)
+):
     """Get comprehensive data for custom landing pages"""
-    try:
-        logger.info(f"Getting landing data for: {spotify_id}")
-        
-        # Get rich metadata
-        metadata = await spotify_service.get_track_metadata(spotify_id)
-        
-        # Get all platform links with deep linking
-        platform_data = await songlink_service.get_detailed_platform_data(metadata.spotify_url)
-        
-        # Get SongLink page info
-        songlink_page = await songlink_service.get_songlink_page_url(metadata.spotify_url)
-        
-        return LandingPageData(
-            title=metadata.title,
-            artist=metadata.artist,
-            album=metadata.album,
-            thumbnail_small=metadata.cover_image,  # Could implement multiple sizes
-            thumbnail_medium=metadata.cover_image,
-            thumbnail_large=metadata.cover_image,
-            platforms=platform_data,
-            songlink_page_url=songlink_page,
-            duration_ms=metadata.duration_ms,
-            isrc=metadata.isrc,
-            release_date=getattr(metadata, 'release_date', None),
-            popularity=getattr(metadata, 'popularity', None),
-            preview_url=metadata.preview_url,
-            spotify_id=spotify_id
-        )
-        
-    except Exception as e:
-        logger.error(f"Landing page data failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Landing page data failed: {str(e)}")
+    logger.info(f"Getting landing data for: {spotify_id}")
+    
+    metadata, links_data = await _fetch_all(spotify_service, songlink_service, spotify_id)
+    platform_data = await songlink_service.get_detailed_platform_data(metadata.spotify_url, links_data)
+    songlink_page = await songlink_service.get_songlink_page_url(metadata.spotify_url, links_data)
+    
+    return _assemble_landing(metadata, platform_data, songlink_page)
 
 # Optimized preview card data
 @app.get("/preview-card/{spotify_id}", response_model=PreviewCardData)
-async def get_preview_card_data(spotify_id: str):
+async def get_preview_card_data(
+    spotify_id: str,
+    spotify_service: SpotifyService = Depends(get_spotify_service),
+    songlink_service: SongLinkService = Depends(get_songlink_service)
+):
     """Get optimized data for preview cards/widgets"""
-    try:
-        landing_data = await get_landing_page_data(spotify_id)
-        
-        return PreviewCardData(
-            title=landing_data.title,
-            artist=landing_data.artist,
-            album=landing_data.album,
-            cover_art=landing_data.thumbnail_medium,
-            duration=f"{landing_data.duration_ms // 60000}:{(landing_data.duration_ms % 60000) // 1000:02d}" if landing_data.duration_ms else None,
-            preview_url=landing_data.preview_url,
-            quick_links={
-                "spotify": landing_data.platforms.spotify.url if landing_data.platforms.spotify else None,
-                "apple_music": landing_data.platforms.apple_music.url if landing_data.platforms.apple_music else None,
-                "youtube_music": landing_data.platforms.youtube_music.url if landing_data.platforms.youtube_music else None,
-                "deezer": landing_data.platforms.deezer.url if landing_data.platforms.deezer else None
-            },
-            deep_links={
-                "spotify_app": landing_data.platforms.spotify.native_app_uri if landing_data.platforms.spotify else None,
-                "apple_music_app": landing_data.platforms.apple_music.native_app_uri if landing_data.platforms.apple_music else None
-            }
-        )
-        
-    except Exception as e:
-        logger.error(f"Preview card failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Preview card failed: {str(e)}")
+    metadata, links_data = await _fetch_all(spotify_service, songlink_service, spotify_id)
+    platforms = await songlink_service.get_detailed_platform_data(metadata.spotify_url, links_data)
+    
+    return PreviewCardData(
+        title=metadata.title,
+        artist=metadata.artist,
+        album=metadata.album,
+        cover_art=metadata.cover_image,
+        duration_ms=metadata.duration_ms,
+        preview_url=metadata.preview_url,
+        quick_links={
+            "spotify": platforms.spotify.url if platforms.spotify else None,
+            "apple_music": platforms.apple_music.url if platforms.apple_music else None,
+            "youtube_music": platforms.youtube_music.url if platforms.youtube_music else None,
+            "deezer": platforms.deezer.url if platforms.deezer else None
+        },
+        deep_links={
+            "spotify_app": platforms.spotify.native_app_uri if platforms.spotify else None,
+            "apple_music_app": platforms.apple_music.native_app_uri if platforms.apple_music else None
+        }
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, Field, computed_field
+from typing import Optional, List, Dict, Any, Annotated, Literal, Union
 from enum import Enum
 
 class ContentType(str, Enum):
@@ -20,7 +20,9 @@ class TrackMetadata(BaseModel):
     spotify_id: str
     spotify_url: str
     preview_url: Optional[str]
-    content_type: str = "track"
+    release_date: Optional[str] = None
+    popularity: Optional[int] = None
+    content_type: Literal["track"] = "track"
 
 class AlbumMetadata(BaseModel):
     title: str
@@ -30,12 +32,15 @@ class AlbumMetadata(BaseModel):
     release_date: str
     spotify_id: str
     spotify_url: str
-    content_type: str = "album"
+    content_type: Literal["album"] = "album"
+
+# Tagged by content_type so validation dispatches straight to the right model
+SearchResult = Annotated[Union[TrackMetadata, AlbumMetadata], Field(discriminator="content_type")]
 
 class SearchResponse(BaseModel):
     query: str
     total_results: int
-    results: List[Any]  # Mix of TrackMetadata and AlbumMetadata
+    results: List[SearchResult]
 
 class PlatformInfo(BaseModel):
     url: Optional[str] = None
@@ -89,7 +94,16 @@ class PreviewCardData(BaseModel):
     artist: str
     album: Optional[str]
     cover_art: Optional[str]
-    duration: Optional[str]
+    duration_ms: Optional[int]
     preview_url: Optional[str]
     quick_links: Dict[str, Optional[str]]
-    deep_links: Dict[str, Optional[str]]
\ No newline at end of file
+    deep_links: Dict[str, Optional[str]]
+    
+    @computed_field
+    @property
+    def duration(self) -> Optional[str]:
+        """Duration as m:ss, computed only when serialized"""
+        if not self.duration_ms:
+            return None
+        minutes, remainder = divmod(self.duration_ms, 60000)
+        return f"{minutes}:{remainder // 1000:02d}"
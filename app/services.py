@@ -1,15 +1,89 @@
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
-import requests
+import httpx
+import hishel
+import orjson
 import re
-from fuzzywuzzy import fuzz
-from typing import List, Optional
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
+import asyncio
+import time
+from pathlib import Path
+from functools import lru_cache
+from operator import itemgetter
+import heapq
+from rapidfuzz import fuzz, process
+from typing import Any, Dict, List, Optional, Tuple
 import logging
 from .config import settings
 from .models import *
 
 logger = logging.getLogger(__name__)
 
+_FEAT_RE = re.compile(r'\(feat\..*?\)|\(featuring.*?\)', re.IGNORECASE)
+_WS_RE = re.compile(r'\s+')
+
+class BatchLoader:
+    """Coalesces single-ID lookups made within a short window into bulk API calls"""
+    
+    def __init__(self, load_many, batch_size: int, window: float):
+        self._load_many = load_many
+        self._batch_size = batch_size
+        self._window = window
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    async def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """Queue a key for the next batch and wait for its result"""
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush())
+        # Shield so one cancelled caller doesn't cancel a result others share
+        return await asyncio.shield(future)
+    
+    async def _flush(self):
+        await asyncio.sleep(self._window)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        
+        keys = list(pending)
+        chunks = [keys[i:i + self._batch_size] for i in range(0, len(keys), self._batch_size)]
+        await asyncio.gather(*(self._resolve(chunk, pending) for chunk in chunks))
+    
+    async def _resolve(self, keys: List[str], futures: Dict[str, asyncio.Future]):
+        try:
+            results = await self._load_many(keys)
+        except Exception as e:
+            if len(keys) > 1 and isinstance(e, spotipy.SpotifyException) and e.http_status == 400:
+                # One malformed ID fails the whole request, so retry them individually
+                await asyncio.gather(*(self._resolve([key], futures) for key in keys))
+            else:
+                # Rate limits, 5xx and timeouts affect every ID; retrying singly would only add load
+                for key in keys:
+                    futures[key].set_exception(e)
+            return
+        
+        for key in keys:
+            futures[key].set_result(results.get(key))
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """Applies a concurrency cap and rate limit to requests that reach the network"""
+    
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_concurrency: int, requests_per_minute: int):
+        self._transport = transport
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._limiter = AsyncLimiter(max_rate=requests_per_minute, time_period=60)
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        async with self._sem, self._limiter:
+            return await self._transport.handle_async_request(request)
+    
+    async def aclose(self):
+        await self._transport.aclose()
+
 class SpotifyService:
     def __init__(self):
         self.spotify = spotipy.Spotify(
@@ -18,109 +92,188 @@ class SpotifyService:
                 client_secret=settings.spotify_client_secret
             )
         )
+        self._track_cache = TTLCache(maxsize=settings.metadata_cache_size, ttl=settings.metadata_cache_ttl)
+        self._album_cache = TTLCache(maxsize=settings.metadata_cache_size, ttl=settings.metadata_cache_ttl)
+        self._sem = asyncio.Semaphore(settings.max_concurrency)
+        self._limiter = AsyncLimiter(max_rate=settings.spotify_requests_per_minute, time_period=60)
+        window = settings.spotify_batch_window_ms / 1000
+        self._track_loader = BatchLoader(self._fetch_tracks, batch_size=50, window=window)
+        self._album_loader = BatchLoader(self._fetch_albums, batch_size=20, window=window)
+        self._health: Optional[Tuple[float, bool]] = None
     
-    def test_connection(self) -> bool:
-        """Test Spotify API connection"""
+    async def _call(self, method, *args, **kwargs):
+        """Call a blocking spotipy method in a worker thread, within the concurrency and rate limits"""
+        async with self._sem, self._limiter:
+            return await asyncio.to_thread(method, *args, **kwargs)
+    
+    async def warm_up(self):
+        """Obtain the client-credentials token ahead of the first request"""
         try:
-            self.spotify.search(q="test", type="track", limit=1)
-            return True
+            await asyncio.to_thread(self.spotify.auth_manager.get_access_token, as_dict=False)
+        except Exception as e:
+            logger.warning(f"Spotify warm-up failed: {e}")
+    
+    async def test_connection(self) -> bool:
+        """Test Spotify API connection, reusing the result for health_cache_ttl seconds"""
+        now = time.monotonic()
+        if self._health is not None and now - self._health[0] < settings.health_cache_ttl:
+            return self._health[1]
+        
+        try:
+            # Spotipy caches the token until expiry, so this rarely hits the network
+            await asyncio.to_thread(self.spotify.auth_manager.get_access_token, as_dict=False)
+            status = True
         except Exception as e:
             logger.error(f"Spotify connection test failed: {e}")
-            return False
+            status = False
+        
+        self._health = (now, status)
+        return status
     
-    def clean_string(self, s: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def clean_string(s: str) -> str:
         """Clean string for better matching"""
-        s = re.sub(r'\(feat\..*?\)|\(featuring.*?\)', '', s, flags=re.IGNORECASE)
-        s = re.sub(r'\s+', ' ', s).strip().lower()
-        return s
+        return _WS_RE.sub(' ', _FEAT_RE.sub('', s)).strip().lower()
     
-    def calculate_relevance_score(self, query: str, title: str, artist: str) -> float:
-        """Calculate relevance score for search results"""
+    def _fuzzy_ratios(self, query: str, choices: List[str]) -> List[float]:
+        """Score every choice against the query in a single RapidFuzz pass (0-1)"""
+        scores = [0.0] * len(choices)
+        for _, score, index in process.extract(query, choices, scorer=fuzz.ratio, limit=None):
+            scores[index] = score / 100
+        return scores
+    
+    def calculate_relevance_scores(self, query: str, candidates: List[Tuple[str, str]]) -> List[float]:
+        """Calculate relevance scores for (title, artist) search results"""
         query_clean = self.clean_string(query)
-        title_clean = self.clean_string(title)
-        artist_clean = self.clean_string(artist)
-        
-        title_exact_match = query_clean in title_clean or title_clean in query_clean
-        artist_match = query_clean in artist_clean or artist_clean in query_clean
+        titles = [self.clean_string(title) for title, _ in candidates]
+        artists = [self.clean_string(artist) for _, artist in candidates]
+        combined = [f"{title} {artist}" for title, artist in zip(titles, artists)]
         
-        title_fuzzy = fuzz.ratio(query_clean, title_clean) / 100
-        artist_fuzzy = fuzz.ratio(query_clean, artist_clean) / 100
-        combined_fuzzy = fuzz.ratio(query_clean, f"{title_clean} {artist_clean}") / 100
+        title_fuzzy = self._fuzzy_ratios(query_clean, titles)
+        artist_fuzzy = self._fuzzy_ratios(query_clean, artists)
+        combined_fuzzy = self._fuzzy_ratios(query_clean, combined)
         
-        score = 0
-        if title_exact_match:
-            score += 0.5
-        if artist_match:
-            score += 0.3
-        
-        score += (title_fuzzy * 0.4 + artist_fuzzy * 0.2 + combined_fuzzy * 0.3)
-        return min(1.0, score)
+        scores = []
+        for i, (title_clean, artist_clean) in enumerate(zip(titles, artists)):
+            title_exact_match = query_clean in title_clean or title_clean in query_clean
+            artist_match = query_clean in artist_clean or artist_clean in query_clean
+            
+            score = 0
+            if title_exact_match:
+                score += 0.5
+            if artist_match:
+                score += 0.3
+            
+            score += (title_fuzzy[i] * 0.4 + artist_fuzzy[i] * 0.2 + combined_fuzzy[i] * 0.3)
+            scores.append(min(1.0, score))
+        return scores
+    
+    def _format_track(self, track: Dict[str, Any]) -> TrackMetadata:
+        """Build TrackMetadata from a Spotify track object"""
+        return TrackMetadata(
+            title=track['name'],
+            artist=", ".join([artist['name'] for artist in track['artists']]),
+            album=track['album']['name'],
+            cover_image=track['album']['images'][0]['url'] if track['album']['images'] else None,
+            duration_ms=track['duration_ms'],
+            isrc=track.get('external_ids', {}).get('isrc'),
+            spotify_id=track['id'],
+            spotify_url=track['external_urls']['spotify'],
+            preview_url=track.get('preview_url'),
+            release_date=track['album'].get('release_date'),
+            popularity=track.get('popularity'),
+            content_type="track"
+        )
+    
+    def _format_album(self, album: Dict[str, Any]) -> AlbumMetadata:
+        """Build AlbumMetadata from a Spotify album object"""
+        return AlbumMetadata(
+            title=album['name'],
+            artist=", ".join([artist['name'] for artist in album['artists']]),
+            cover_image=album['images'][0]['url'] if album['images'] else None,
+            total_tracks=album['total_tracks'],
+            release_date=album['release_date'],
+            spotify_id=album['id'],
+            spotify_url=album['external_urls']['spotify'],
+            content_type="album"
+        )
     
-    async def search_mixed(self, query: str, limit: int = 10) -> List[Any]:
+    async def search_mixed(self, query: str, limit: int = 10) -> List[SearchResult]:
         """Search for both tracks and albums, return mixed results"""
         try:
             # Search both tracks and albums
-            track_results = self.spotify.search(q=query, type="track", limit=max(5, limit // 2))
-            album_results = self.spotify.search(q=query, type="album", limit=max(3, limit // 3))
-            
-            mixed_results = []
-            
-            # Process tracks
-            for track in track_results['tracks']['items']:
-                metadata = TrackMetadata(
-                    title=track['name'],
-                    artist=", ".join([artist['name'] for artist in track['artists']]),
-                    album=track['album']['name'],
-                    cover_image=track['album']['images'][0]['url'] if track['album']['images'] else None,
-                    duration_ms=track['duration_ms'],
-                    isrc=track.get('external_ids', {}).get('isrc'),
-                    spotify_id=track['id'],
-                    spotify_url=track['external_urls']['spotify'],
-                    preview_url=track.get('preview_url'),
-                    content_type="track"
-                )
-                relevance = self.calculate_relevance_score(query, track['name'], track['artists'][0]['name'])
-                mixed_results.append((metadata, relevance))
-            
-            # Process albums
-            for album in album_results['albums']['items']:
-                metadata = AlbumMetadata(
-                    title=album['name'],
-                    artist=", ".join([artist['name'] for artist in album['artists']]),
-                    cover_image=album['images'][0]['url'] if album['images'] else None,
-                    total_tracks=album['total_tracks'],
-                    release_date=album['release_date'],
-                    spotify_id=album['id'],
-                    spotify_url=album['external_urls']['spotify'],
-                    content_type="album"
-                )
-                relevance = self.calculate_relevance_score(query, album['name'], album['artists'][0]['name'])
-                mixed_results.append((metadata, relevance))
+            track_results, album_results = await asyncio.gather(
+                self._call(self.spotify.search, q=query, type="track", limit=max(5, limit // 2)),
+                self._call(self.spotify.search, q=query, type="album", limit=max(3, limit // 3))
+            )
             
-            # Sort by relevance and return top results
-            mixed_results.sort(key=lambda x: x[1], reverse=True)
-            return [item[0] for item in mixed_results[:limit]]
+            tracks = track_results['tracks']['items']
+            albums = album_results['albums']['items']
+            items = tracks + albums
+            results = [self._format_track(track) for track in tracks] + [self._format_album(album) for album in albums]
+            
+            # Score all candidates in one batch
+            relevance = self.calculate_relevance_scores(
+                query, [(item['name'], item['artists'][0]['name']) for item in items]
+            )
+            mixed_results = list(zip(results, relevance))
+            
+            # Return the most relevant results without sorting the rest
+            return [metadata for metadata, _ in heapq.nlargest(limit, mixed_results, key=itemgetter(1))]
             
         except Exception as e:
             logger.error(f"Mixed search failed: {e}")
             raise e
     
+    async def _fetch_tracks(self, spotify_ids: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Fetch up to 50 raw track objects in one request"""
+        response = await self._call(self.spotify.tracks, spotify_ids)
+        return dict(zip(spotify_ids, response['tracks']))
+    
+    async def _fetch_albums(self, spotify_ids: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Fetch up to 20 raw album objects in one request"""
+        response = await self._call(self.spotify.albums, spotify_ids)
+        return dict(zip(spotify_ids, response['albums']))
+    
+    async def _raw_track(self, spotify_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch a raw Spotify track object (None if unknown), memoized for metadata_cache_ttl"""
+        track = self._track_cache.get(spotify_id)
+        if track is None:
+            track = await self._track_loader.load(spotify_id)
+            if track is not None:
+                self._track_cache[spotify_id] = track
+        return track
+    
+    async def _raw_album(self, spotify_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch a raw Spotify album object (None if unknown), memoized for metadata_cache_ttl"""
+        album = self._album_cache.get(spotify_id)
+        if album is None:
+            album = await self._album_loader.load(spotify_id)
+            if album is not None:
+                self._album_cache[spotify_id] = album
+        return album
+    
+    async def get_tracks_bulk(self, spotify_ids: List[str]) -> Dict[str, TrackMetadata]:
+        """Get metadata for many tracks at once, skipping IDs Spotify doesn't know"""
+        try:
+            unique_ids = list(dict.fromkeys(spotify_ids))
+            tracks = await asyncio.gather(*(self._raw_track(spotify_id) for spotify_id in unique_ids))
+            return {
+                spotify_id: self._format_track(track)
+                for spotify_id, track in zip(unique_ids, tracks) if track is not None
+            }
+        except Exception as e:
+            logger.error(f"Get tracks bulk failed: {e}")
+            raise e
+    
     async def get_track_metadata(self, spotify_id: str) -> TrackMetadata:
         """Get detailed track metadata"""
         try:
-            track = self.spotify.track(spotify_id)
-            return TrackMetadata(
-                title=track['name'],
-                artist=", ".join([artist['name'] for artist in track['artists']]),
-                album=track['album']['name'],
-                cover_image=track['album']['images'][0]['url'] if track['album']['images'] else None,
-                duration_ms=track['duration_ms'],
-                isrc=track.get('external_ids', {}).get('isrc'),
-                spotify_id=track['id'],
-                spotify_url=track['external_urls']['spotify'],
-                preview_url=track.get('preview_url'),
-                content_type="track"
-            )
+            track = await self._raw_track(spotify_id)
+            if track is None:
+                raise spotipy.SpotifyException(404, -1, f"Track not found: {spotify_id}")
+            return self._format_track(track)
         except Exception as e:
             logger.error(f"Get track metadata failed: {e}")
             raise e
@@ -128,17 +281,10 @@ class SpotifyService:
     async def get_album_metadata(self, spotify_id: str) -> AlbumMetadata:
         """Get detailed album metadata"""
         try:
-            album = self.spotify.album(spotify_id)
-            return AlbumMetadata(
-                title=album['name'],
-                artist=", ".join([artist['name'] for artist in album['artists']]),
-                cover_image=album['images'][0]['url'] if album['images'] else None,
-                total_tracks=album['total_tracks'],
-                release_date=album['release_date'],
-                spotify_id=album['id'],
-                spotify_url=album['external_urls']['spotify'],
-                content_type="album"
-            )
+            album = await self._raw_album(spotify_id)
+            if album is None:
+                raise spotipy.SpotifyException(404, -1, f"Album not found: {spotify_id}")
+            return self._format_album(album)
         except Exception as e:
             logger.error(f"Get album metadata failed: {e}")
             raise e
@@ -146,18 +292,77 @@ class SpotifyService:
 class SongLinkService:
     def __init__(self):
         self.base_url = "https://api.song.link/v1-alpha.1"
+        network = RateLimitedTransport(
+            httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(
+                    max_connections=settings.max_concurrency,
+                    max_keepalive_connections=settings.max_concurrency
+                )
+            ),
+            max_concurrency=settings.max_concurrency,
+            requests_per_minute=settings.songlink_requests_per_minute
+        )
+        # Responses persist on disk across restarts and are shared by workers;
+        # cache hits never reach the rate-limited network transport
+        self.client = httpx.AsyncClient(
+            transport=hishel.AsyncCacheTransport(
+                transport=network,
+                storage=hishel.AsyncFileStorage(
+                    base_path=Path(settings.songlink_cache_dir),
+                    ttl=settings.songlink_cache_ttl
+                ),
+                # song.link rarely sends Cache-Control, so allow heuristic freshness for its 200s;
+                # once stale they are revalidated with If-None-Match and refreshed by a 304
+                controller=hishel.Controller(allow_heuristics=True)
+            ),
+            base_url=self.base_url,
+            timeout=10
+        )
+        self._links_cache = TTLCache(maxsize=settings.metadata_cache_size, ttl=settings.metadata_cache_ttl)
     
-    async def get_platform_links(self, spotify_url: str) -> DSPLinks:
-        """Get basic platform links"""
+    async def warm_up(self):
+        """Resolve DNS and complete the TLS handshake ahead of the first request"""
+        try:
+            await self.client.head("/")
+        except Exception as e:
+            logger.warning(f"SongLink warm-up failed: {e}")
+    
+    async def aclose(self):
+        """Close the shared HTTP client"""
+        await self.client.aclose()
+    
+    async def fetch_links(self, spotify_url: str) -> Dict[str, Any]:
+        """Fetch the raw SongLink response for a URL (empty dict if unavailable)"""
+        cached = self._links_cache.get(spotify_url)
+        if cached is not None:
+            return cached
+        
         try:
-            api_url = f"{self.base_url}/links?url={spotify_url}"
-            response = requests.get(api_url, timeout=10)
+            # Stale disk-cache entries are revalidated with If-None-Match; on a 304 the
+            # stored body is returned as a 200 instead of being downloaded again
+            response = await self.client.get("/links", params={"url": spotify_url})
             
             if response.status_code != 200:
                 logger.warning(f"SongLink API error: {response.status_code}")
+                return {}
+            
+            data = orjson.loads(response.content)
+            # Only successful lookups are cached so failures are retried
+            self._links_cache[spotify_url] = data
+            return data
+            
+        except Exception as e:
+            logger.error(f"SongLink API error: {e}")
+            return {}
+    
+    async def get_platform_links(self, spotify_url: str, data: Optional[Dict[str, Any]] = None) -> DSPLinks:
+        """Get basic platform links"""
+        try:
+            if data is None:
+                data = await self.fetch_links(spotify_url)
+            if not data:
                 return DSPLinks(spotify=spotify_url)
             
-            data = response.json()
             links = data.get('linksByPlatform', {})
             
             return DSPLinks(
@@ -174,18 +379,16 @@ class SongLinkService:
             logger.error(f"SongLink API error: {e}")
             return DSPLinks(spotify=spotify_url)
     
-    async def get_detailed_platform_data(self, spotify_url: str) -> DetailedPlatformLinks:
+    async def get_detailed_platform_data(self, spotify_url: str, data: Optional[Dict[str, Any]] = None) -> DetailedPlatformLinks:
         """Get detailed platform data with deep links"""
         try:
-            api_url = f"{self.base_url}/links?url={spotify_url}"
-            response = requests.get(api_url, timeout=10)
-            
-            if response.status_code != 200:
+            if data is None:
+                data = await self.fetch_links(spotify_url)
+            if not data:
                 return DetailedPlatformLinks(
                     spotify=PlatformInfo(url=spotify_url)
                 )
             
-            data = response.json()
             links = data.get('linksByPlatform', {})
             
             return DetailedPlatformLinks(
@@ -219,18 +422,18 @@ class SongLinkService:
             logger.error(f"Detailed platform data error: {e}")
             return DetailedPlatformLinks(spotify=PlatformInfo(url=spotify_url))
     
-    async def get_songlink_page_url(self, spotify_url: str) -> str:
+    async def get_songlink_page_url(self, spotify_url: str, data: Optional[Dict[str, Any]] = None) -> str:
         """Get SongLink shareable page URL"""
+        fallback = f"https://song.link/{spotify_url}"
         try:
-            api_url = f"{self.base_url}/links?url={spotify_url}"
-            response = requests.get(api_url, timeout=10)
+            # The deterministic URL is almost always canonical, so only hit the API when asked to
+            if data is None and settings.resolve_page_url_strict:
+                data = await self.fetch_links(spotify_url)
+            if not data:
+                return fallback
             
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('pageUrl', f"https://song.link/{spotify_url}")
-            else:
-                return f"https://song.link/{spotify_url}"
+            return data.get('pageUrl', fallback)
                 
         except Exception as e:
             logger.error(f"SongLink page URL error: {e}")
-            return f"https://song.link/{spotify_url}"
\ No newline at end of file
+            return fallback